@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -155,3 +156,38 @@ CSRF_TRUSTED_ORIGINS = [
     "http://localhost:3000",
     "http://127.0.0.1:3000",
 ]
+
+# Ticket auto-assignment (see ticket/assignment.py)
+# One of 'least_loaded', 'round_robin', 'weighted', or a dotted path to an
+# AssignmentStrategy subclass.
+TICKET_ASSIGNMENT_STRATEGY = 'least_loaded'
+# {staff user id: weight}, used by the 'weighted' strategy.
+TICKET_ASSIGNMENT_WEIGHTS = {}
+# How often each process writes its assignments to the shared per-staff load
+# counters and reloads them with the other processes' assignments.
+TICKET_ASSIGNMENT_SYNC_SECONDS = 1
+
+# Ticket sharding (see ticket/sharding.py)
+# Tickets, comments and status history are spread over TICKET_SHARDS by the
+# user who opened the ticket. Set TICKET_SHARD_COUNT to try it locally with
+# several SQLite files, then run `migrate --database shardN` for each shard.
+TICKET_SHARDS = ['default']
+TICKET_SHARD_COUNT = int(os.environ.get('TICKET_SHARD_COUNT', '0'))
+if TICKET_SHARD_COUNT:
+    TICKET_SHARDS = [f'shard{i}' for i in range(TICKET_SHARD_COUNT)]
+    for shard in TICKET_SHARDS:
+        DATABASES[shard] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / f'db_{shard}.sqlite3',
+        }
+else:
+    # Spare databases for the sharding tests. They are not in TICKET_SHARDS,
+    # so nothing but the tests (which get in-memory copies) uses them.
+    for shard in ('shard0', 'shard1'):
+        DATABASES[shard] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / f'db_{shard}.sqlite3',
+            'TEST': {'NAME': f'file:test_{shard}?mode=memory&cache=shared'},
+        }
+
+DATABASE_ROUTERS = ['ticket.sharding.TicketShardRouter']
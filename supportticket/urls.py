@@ -17,7 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from ticket.views import TicketViewSet, CommentViewSet
+from ticket.views import TicketViewSet, CommentViewSet, ticket_metrics_view
 import user.views as user_views
 
 # Create a router and register our viewsets
@@ -28,6 +28,7 @@ router.register(r'comments', CommentViewSet, basename='comment')
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include(router.urls)),
+    path('api/metrics/', ticket_metrics_view, name='api_ticket_metrics'),
     path('api/auth/register/', user_views.register_view, name='api_register'),
     path('api/auth/login/', user_views.login_view, name='api_login'),
     path('api/auth/logout/', user_views.logout_view, name='api_logout'),
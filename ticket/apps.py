@@ -4,3 +4,20 @@ from django.apps import AppConfig
 class TicketConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ticket'
+
+    def ready(self):
+        from django.conf import settings
+        from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+        from . import assignment, sharding
+        from .models import Ticket
+
+        # Fail at startup rather than on the first ticket if
+        # TICKET_ASSIGNMENT_STRATEGY is broken.
+        assignment.get_default_strategy()
+
+        post_save.connect(assignment.user_saved, sender=settings.AUTH_USER_MODEL)
+        post_delete.connect(assignment.ticket_deleted, sender=Ticket)
+
+        for model in sharding.SHARDED_MODELS:
+            pre_save.connect(sharding.assign_id, sender=model)
+        pre_delete.connect(sharding.user_deleting, sender=settings.AUTH_USER_MODEL)
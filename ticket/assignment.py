@@ -0,0 +1,332 @@
+"""
+Auto-assignment of new tickets to staff members.
+
+New tickets are routed to an active staff member chosen by a pluggable
+strategy. Strategies pick from per-staff load counters (number of
+open/in_progress tickets) instead of counting tickets for every create.
+
+The counters are stored in ``StaffLoad`` on the default database and cached
+in each worker process, so picking a staff member doesn't touch the database:
+- ``acquire`` lets the strategy choose from the cached counts and increments
+  the chosen one.
+- ``release`` gives the slot back if the ticket could not be saved.
+- ``record_transition`` is called whenever a ticket's status changes.
+- Deleting a ticket and promoting a user to staff are handled by signals.
+
+Every ``TICKET_ASSIGNMENT_SYNC_SECONDS`` a process writes its changes to
+``StaffLoad`` as ``F()`` deltas and reloads the counts, picking up the other
+processes' assignments. Counters for staff members who don't have one yet
+are created from one aggregated query per ticket shard.
+"""
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Count, DateTimeField, F, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import StaffLoad, Ticket
+from .sharding import DEFAULT_DB, get_ticket_databases
+
+User = get_user_model()
+
+# Statuses that count towards a staff member's load.
+ACTIVE_STATUSES = ('open', 'in_progress')
+
+NEVER = datetime.min.replace(tzinfo=dt_timezone.utc)
+
+
+class AssignmentStrategy(ABC):
+    """
+    Base class for assignment strategies.
+
+    ``choose`` receives the cached ``StaffLoad`` rows of the active staff
+    members (never empty, ordered by staff id) and returns one of them.
+    """
+
+    @abstractmethod
+    def choose(self, loads):
+        """
+        Return the row of the staff member to assign the next ticket to.
+        """
+
+
+class LeastLoadedStrategy(AssignmentStrategy):
+    """
+    Pick the staff member with the fewest active tickets (lowest id on ties).
+    """
+
+    def choose(self, loads):
+        return min(loads, key=lambda load: (load.active_tickets, load.staff_id))
+
+
+class RoundRobinStrategy(AssignmentStrategy):
+    """
+    Cycle through staff members in id order, ignoring their load: pick whoever
+    was assigned a ticket least recently.
+    """
+
+    def choose(self, loads):
+        return min(loads, key=lambda load: (load.last_assigned_at or NEVER, load.staff_id))
+
+
+class WeightedStrategy(AssignmentStrategy):
+    """
+    Least-loaded relative to capacity: staff member with weight 2 receives
+    roughly twice as many tickets as one with weight 1.
+
+    Weights are read from ``TICKET_ASSIGNMENT_WEIGHTS`` ({staff id: weight});
+    staff members without an entry get a weight of 1, and a weight of 0 only
+    receives tickets when nobody else can.
+    """
+
+    def __init__(self, weights=None):
+        if weights is None:
+            weights = getattr(settings, 'TICKET_ASSIGNMENT_WEIGHTS', {})
+        self.weights = {int(staff_id): weight for staff_id, weight in weights.items()}
+
+    def choose(self, loads):
+        def key(load):
+            weight = self.weights.get(load.staff_id, 1)
+            if weight <= 0:
+                return (float('inf'), load.active_tickets, load.staff_id)
+            return ((load.active_tickets + 1) / weight, 0, load.staff_id)
+        return min(loads, key=key)
+
+
+STRATEGIES = {
+    'least_loaded': LeastLoadedStrategy,
+    'round_robin': RoundRobinStrategy,
+    'weighted': WeightedStrategy,
+}
+
+
+def get_strategy(name=None):
+    """
+    Build the strategy named by ``TICKET_ASSIGNMENT_STRATEGY``.
+
+    The name is either a key of ``STRATEGIES`` or a dotted path to an
+    ``AssignmentStrategy`` subclass.
+    """
+    if name is None:
+        name = getattr(settings, 'TICKET_ASSIGNMENT_STRATEGY', 'least_loaded')
+    strategy_class = STRATEGIES.get(name) or import_string(name)
+    if not (isinstance(strategy_class, type) and issubclass(strategy_class, AssignmentStrategy)):
+        raise ImproperlyConfigured(f'{name!r} is not an AssignmentStrategy subclass.')
+    return strategy_class()
+
+
+class LoadIndex:
+    """
+    Active ticket counts per active staff member.
+
+    Counts are cached per process and changed in memory; the changes are
+    written to ``StaffLoad`` by ``sync()``, which also reloads the cache and
+    runs whenever the cache is older than ``sync_seconds``.
+    """
+
+    def __init__(self, sync_seconds=None):
+        if sync_seconds is None:
+            sync_seconds = getattr(settings, 'TICKET_ASSIGNMENT_SYNC_SECONDS', 1)
+        self.sync_seconds = sync_seconds
+        self._lock = threading.Lock()
+        self._loads = None
+        self._synced_at = 0.0
+        # Changes not written to StaffLoad yet: {staff id: delta} and
+        # {staff id: last assignment}.
+        self._deltas = {}
+        self._assigned = {}
+
+    def _stale(self):
+        with self._lock:
+            return self._loads is None or time.monotonic() - self._synced_at >= self.sync_seconds
+
+    def sync(self):
+        """
+        Write this process's changes to ``StaffLoad`` and reload the counts,
+        creating counters for active staff members that don't have one yet.
+        """
+        self._flush()
+
+        staff_ids = list(User.objects.filter(is_staff=True, is_active=True).order_by('id').values_list('id', flat=True))
+        rows = StaffLoad.objects.in_bulk(staff_ids)
+        missing = set(staff_ids) - set(rows)
+        if missing:
+            counts = dict.fromkeys(missing, 0)
+            for db in get_ticket_databases():
+                tickets = (
+                    Ticket.objects.using(db)
+                    .filter(assignee_id__in=missing, status__in=ACTIVE_STATUSES)
+                    .values('assignee_id')
+                    .annotate(count=Count('id'))
+                )
+                for row in tickets:
+                    counts[row['assignee_id']] += row['count']
+            StaffLoad.objects.bulk_create(
+                [StaffLoad(staff_id=staff_id, active_tickets=count) for staff_id, count in counts.items()],
+                ignore_conflicts=True,
+            )
+            # Another process may have created some of them first.
+            rows.update(StaffLoad.objects.in_bulk(missing))
+
+        with self._lock:
+            # Changes made since the flush are not in the database yet.
+            for staff_id, delta in self._deltas.items():
+                if staff_id in rows:
+                    rows[staff_id].active_tickets = max(rows[staff_id].active_tickets + delta, 0)
+            for staff_id, assigned_at in self._assigned.items():
+                if staff_id in rows:
+                    rows[staff_id].last_assigned_at = max(rows[staff_id].last_assigned_at or NEVER, assigned_at)
+            self._loads = {staff_id: rows[staff_id] for staff_id in staff_ids if staff_id in rows}
+            self._synced_at = time.monotonic()
+
+    def _flush(self):
+        if transaction.get_connection(DEFAULT_DB).in_atomic_block:
+            # Writing now would lose the changes if the caller's transaction
+            # rolls back; they stay pending until it commits.
+            transaction.on_commit(self._write_changes, using=DEFAULT_DB)
+        else:
+            self._write_changes()
+
+    def _write_changes(self):
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+            assigned, self._assigned = self._assigned, {}
+        try:
+            with transaction.atomic(using=DEFAULT_DB):
+                for staff_id in deltas.keys() | assigned.keys():
+                    changes = {}
+                    if deltas.get(staff_id):
+                        changes['active_tickets'] = Greatest(F('active_tickets') + deltas[staff_id], 0)
+                    if staff_id in assigned:
+                        assigned_at = Value(assigned[staff_id], output_field=DateTimeField())
+                        changes['last_assigned_at'] = Greatest(Coalesce('last_assigned_at', assigned_at), assigned_at)
+                    if changes:
+                        StaffLoad.objects.filter(staff_id=staff_id).update(**changes)
+        except Exception:
+            with self._lock:
+                for staff_id, delta in deltas.items():
+                    self._deltas[staff_id] = self._deltas.get(staff_id, 0) + delta
+                for staff_id, assigned_at in assigned.items():
+                    self._assigned[staff_id] = max(self._assigned.get(staff_id, NEVER), assigned_at)
+            raise
+
+    def acquire(self, strategy):
+        """
+        Choose a staff member and count one more active ticket against them.
+
+        Returns the staff member's id, or None if there is no active staff.
+        """
+        if self._stale():
+            self.sync()
+        with self._lock:
+            if not self._loads:
+                return None
+            chosen = strategy.choose(list(self._loads.values()))
+            now = timezone.now()
+            chosen.active_tickets += 1
+            chosen.last_assigned_at = now
+            self._deltas[chosen.staff_id] = self._deltas.get(chosen.staff_id, 0) + 1
+            self._assigned[chosen.staff_id] = now
+            return chosen.staff_id
+
+    def adjust(self, staff_id, delta):
+        if staff_id is None:
+            return
+        with self._lock:
+            self._deltas[staff_id] = self._deltas.get(staff_id, 0) + delta
+            load = (self._loads or {}).get(staff_id)
+            if load is not None:
+                load.active_tickets = max(load.active_tickets + delta, 0)
+
+    def release(self, staff_id):
+        """
+        Undo an ``acquire`` whose ticket was never saved.
+        """
+        self.adjust(staff_id, -1)
+
+    def record_transition(self, assignee_id, old_status, new_status):
+        """
+        Keep the counters in sync when a ticket moves in or out of an active status.
+        """
+        was_active = old_status in ACTIVE_STATUSES
+        is_active = new_status in ACTIVE_STATUSES
+        if was_active != is_active:
+            self.adjust(assignee_id, 1 if is_active else -1)
+
+    def invalidate(self):
+        """
+        Reload the counts on next use, e.g. after the staff list changed.
+        """
+        with self._lock:
+            self._loads = None
+
+    def snapshot(self):
+        if self._stale():
+            self.sync()
+        with self._lock:
+            return {staff_id: load.active_tickets for staff_id, load in (self._loads or {}).items()}
+
+
+load_index = LoadIndex()
+
+_strategy = None
+_strategy_lock = threading.Lock()
+
+
+def get_default_strategy():
+    global _strategy
+    with _strategy_lock:
+        if _strategy is None:
+            _strategy = get_strategy()
+        return _strategy
+
+
+def create_assigned_ticket(serializer, created_by, using=None, on_created=None, index=None, strategy=None):
+    """
+    Save a new ticket from ``serializer``, assigning it to a staff member.
+
+    The ticket is saved (and ``on_created`` called with it) in a transaction
+    on ``using``; if that fails, the staff member's slot is given back.
+    Falls back to assigning the ticket to its creator if there is no active
+    staff member to route it to.
+    """
+    index = index or load_index
+    strategy = strategy or get_default_strategy()
+
+    staff_id = index.acquire(strategy)
+    try:
+        with transaction.atomic(using=using):
+            ticket = serializer.save(assignee_id=staff_id or created_by.pk, created_by=created_by)
+            if on_created is not None:
+                on_created(ticket)
+    except Exception:
+        index.release(staff_id)
+        raise
+
+    # The slot was reserved as active; correct it if the ticket was created
+    # with another status.
+    index.record_transition(staff_id, 'open', ticket.status)
+    return ticket
+
+
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login; don't re-check the staff list for those.
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    # New staff members need a counter. Former staff keep theirs but are no
+    # longer active, so they are skipped when choosing.
+    if instance.is_staff:
+        load_index.invalidate()
+
+
+def ticket_deleted(sender, instance, **kwargs):
+    if instance.status in ACTIVE_STATUSES:
+        load_index.adjust(instance.assignee_id, -1)
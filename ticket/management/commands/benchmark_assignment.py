@@ -0,0 +1,75 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_databases, teardown_databases
+
+from ticket.assignment import LoadIndex, STRATEGIES, create_assigned_ticket
+from ticket.sharding import get_ticket_databases, shard_for_user
+from ticket.serializers import TicketSerializer
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure ticket auto-assignment throughput. Runs against throwaway test '
+        'databases (as created by `manage.py test`), so real staff loads are '
+        'untouched and each ticket is committed on its own, as in production.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tickets', type=int, default=5000)
+        parser.add_argument('--staff', type=int, default=20)
+        parser.add_argument('--strategy', choices=sorted(STRATEGIES), default='least_loaded')
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(
+            verbosity=0,
+            interactive=False,
+            aliases={'default', *get_ticket_databases()},
+            serialized_aliases=set(),
+        )
+        try:
+            self.run(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def run(self, options):
+        staff = [
+            User(username=f'bench-staff-{i}', name=f'Bench Staff {i}', is_staff=True)
+            for i in range(options['staff'])
+        ]
+        User.objects.bulk_create(staff)
+        requester = User.objects.create(username='bench-requester', name='Bench Requester')
+
+        # Scheduler only: choose a staff member and count the ticket.
+        index = LoadIndex()
+        strategy = STRATEGIES[options['strategy']]()
+        index.sync()
+        start = time.perf_counter()
+        for _ in range(options['tickets']):
+            index.acquire(strategy)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'scheduler: {options["tickets"]} picks in {elapsed:.3f}s '
+            f'({options["tickets"] / elapsed:,.0f}/s)'
+        )
+
+        # End to end: validate, assign and insert each ticket.
+        index = LoadIndex()
+        strategy = STRATEGIES[options['strategy']]()
+        shard = shard_for_user(requester.pk)
+        start = time.perf_counter()
+        for i in range(options['tickets']):
+            serializer = TicketSerializer(data={'title': f'Ticket {i}', 'description': 'Benchmark'})
+            serializer.is_valid(raise_exception=True)
+            create_assigned_ticket(serializer, requester, using=shard, index=index, strategy=strategy)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'creates: {options["tickets"]} tickets in {elapsed:.3f}s '
+            f'({options["tickets"] / elapsed:,.0f}/s)'
+        )
+
+        loads = index.snapshot()
+        self.stdout.write(f'load spread: min={min(loads.values())} max={max(loads.values())}')
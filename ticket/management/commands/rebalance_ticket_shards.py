@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from ticket.sharding import rebalance
+
+
+class Command(BaseCommand):
+    help = (
+        'Move users whose consistent-hash position changed (e.g. after adding '
+        'a shard to TICKET_SHARDS) to their new shard, one user at a time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the users that would move.')
+        parser.add_argument(
+            '--grace-seconds', type=float, default=5,
+            help='How long to wait after blocking writes for a user before copying their tickets.'
+        )
+
+    def handle(self, *args, **options):
+        moved = rebalance(
+            grace_seconds=options['grace_seconds'],
+            dry_run=options['dry_run'],
+            log=self.stdout.write,
+        )
+        verb = 'Would move' if options['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {moved} users.'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ticket.metrics import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily SLA metric rollups from the ticket status history and comments.'
+
+    def handle(self, *args, **options):
+        rows = rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} daily metric rows.'))
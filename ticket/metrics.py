@@ -0,0 +1,302 @@
+"""
+Ticket status history and SLA metrics.
+
+Every status change appends a ``TicketStatusChange`` row and folds the
+resulting durations into ``DailyTicketMetric`` rollups:
+- time_in_status: how long the ticket stayed in the status it just left.
+- resolution: time from creation to a transition into ``closed``.
+- first_response: time from creation to the first comment by someone other
+  than the ticket's creator (``Comment.created_at``).
+
+Each rollup row keeps a count, a total, a maximum and a histogram over
+``BUCKET_BOUNDS``, so reports over any range of days only read one row per
+day and metric, and percentiles are interpolated from the merged histograms.
+"""
+from bisect import bisect_left
+from datetime import timedelta
+from functools import partial
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Comment, DailyTicketMetric, Ticket, TicketStatusChange
+from .sharding import DEFAULT_DB, get_ticket_databases
+
+# Upper bounds (in seconds) of the histogram buckets: 1 minute to ~90 days,
+# each bucket about 19% wider than the previous one. The last bucket holds
+# everything above the final bound.
+BUCKET_BOUNDS = [round(60 * 2 ** (i / 4)) for i in range(69)]
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def _empty_histogram():
+    return [0] * (len(BUCKET_BOUNDS) + 1)
+
+
+class DurationSummary:
+    """
+    Mergeable count/total/max/histogram of durations.
+    """
+
+    def __init__(self, count=0, total_seconds=0.0, max_seconds=0.0, histogram=None):
+        self.count = count
+        self.total_seconds = total_seconds
+        self.max_seconds = max_seconds
+        self.histogram = list(histogram) if histogram else _empty_histogram()
+
+    def add(self, seconds):
+        seconds = max(seconds, 0.0)
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.histogram[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_seconds += other.total_seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        for i, value in enumerate(other.histogram):
+            self.histogram[i] += value
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        target = self.count * p / 100
+        cumulative = 0
+        for i, bucket_count in enumerate(self.histogram):
+            if not bucket_count:
+                continue
+            if cumulative + bucket_count >= target:
+                upper = BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max_seconds
+                upper = min(upper, self.max_seconds)
+                lower = min(BUCKET_BOUNDS[i - 1] if i else 0, upper)
+                fraction = (target - cumulative) / bucket_count
+                return lower + (upper - lower) * fraction
+            cumulative += bucket_count
+        return self.max_seconds
+
+    def as_dict(self):
+        data = {
+            'count': self.count,
+            'mean_seconds': round(self.total_seconds / self.count, 1) if self.count else None,
+            'max_seconds': round(self.max_seconds, 1) if self.count else None,
+        }
+        for p in PERCENTILES:
+            value = self.percentile(p)
+            data[f'p{p}_seconds'] = round(value, 1) if value is not None else None
+        return data
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row.count, row.total_seconds, row.max_seconds, row.histogram)
+
+
+def _record_duration(metric, when, seconds, status=''):
+    """
+    Add one duration to the rollup for the day of ``when``.
+
+    Rollups live on the default database; the row is locked so concurrent
+    updates of the same day don't lose samples.
+    """
+    with transaction.atomic(using=DEFAULT_DB):
+        row, _ = DailyTicketMetric.objects.select_for_update().get_or_create(
+            date=timezone.localdate(when),
+            metric=metric,
+            status=status,
+            defaults={'histogram': _empty_histogram()},
+        )
+        summary = DurationSummary.from_row(row)
+        summary.add(seconds)
+        row.count = summary.count
+        row.total_seconds = summary.total_seconds
+        row.max_seconds = summary.max_seconds
+        row.histogram = summary.histogram
+        row.save()
+
+
+def _schedule_duration(ticket, metric, when, seconds, status=''):
+    """
+    Record a duration once the transaction on the ticket's database commits.
+
+    The rollups are on another database, so writing them right away would
+    count transitions that are then rolled back. A failed rollup write is
+    logged rather than failing the request; ``rebuild_rollups`` repairs it.
+    """
+    transaction.on_commit(
+        partial(_record_duration, metric, when, seconds, status),
+        using=ticket._state.db,
+        robust=True,
+    )
+
+
+def record_ticket_created(ticket, user=None):
+    TicketStatusChange.objects.create(
+        ticket=ticket,
+        from_status='',
+        to_status=ticket.status,
+        changed_by=user,
+        changed_at=ticket.created_at,
+    )
+
+
+def record_status_change(ticket, old_status, new_status, user=None, when=None):
+    """
+    Append a transition to the ticket's history and update the rollups.
+    """
+    if old_status == new_status:
+        return None
+    when = when or timezone.now()
+
+    with transaction.atomic(using=ticket._state.db):
+        entered_at = (
+            ticket.status_changes.order_by('-changed_at', '-id')
+            .values_list('changed_at', flat=True)
+            .first()
+        ) or ticket.created_at
+
+        change = TicketStatusChange.objects.create(
+            ticket=ticket,
+            from_status=old_status,
+            to_status=new_status,
+            changed_by=user,
+            changed_at=when,
+        )
+        _schedule_duration(
+            ticket, DailyTicketMetric.TIME_IN_STATUS, when,
+            (when - entered_at).total_seconds(), status=old_status
+        )
+        if new_status == 'closed':
+            _schedule_duration(
+                ticket, DailyTicketMetric.RESOLUTION, when,
+                (when - ticket.created_at).total_seconds()
+            )
+    return change
+
+
+def record_comment(comment):
+    """
+    Record time to first response if ``comment`` is the ticket's first reply.
+    """
+    ticket = comment.ticket
+    requester_id = ticket.created_by_id or ticket.assignee_id
+    if comment.author_id == requester_id:
+        return
+
+    with transaction.atomic(using=ticket._state.db):
+        # The conditional update only succeeds for the first reply, even
+        # when several are posted at once.
+        first = Ticket.objects.using(ticket._state.db).filter(pk=ticket.pk, first_response_at__isnull=True).update(
+            first_response_at=comment.created_at
+        )
+        if first:
+            ticket.first_response_at = comment.created_at
+            _schedule_duration(
+                ticket, DailyTicketMetric.FIRST_RESPONSE, comment.created_at,
+                (comment.created_at - ticket.created_at).total_seconds()
+            )
+
+
+def report(start, end):
+    """
+    Summarise the rollups for the days from ``start`` to ``end`` (inclusive).
+    """
+    first_response = DurationSummary()
+    resolution = DurationSummary()
+    time_in_status = {}
+
+    rows = DailyTicketMetric.objects.filter(date__range=(start, end))
+    for row in rows.iterator():
+        summary = DurationSummary.from_row(row)
+        if row.metric == DailyTicketMetric.FIRST_RESPONSE:
+            first_response.merge(summary)
+        elif row.metric == DailyTicketMetric.RESOLUTION:
+            resolution.merge(summary)
+        else:
+            time_in_status.setdefault(row.status, DurationSummary()).merge(summary)
+
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'first_response': first_response.as_dict(),
+        'resolution': resolution.as_dict(),
+        'time_in_status': {
+            status: summary.as_dict() for status, summary in sorted(time_in_status.items())
+        },
+    }
+
+
+def rebuild_rollups():
+    """
+    Recompute all rollups and ``Ticket.first_response_at`` from the history.
+
+    Used to backfill after the history tables are introduced, or to repair
+    rollups after manual data changes. The history is streamed in ticket
+    order, one shard at a time, rather than loaded per ticket.
+    """
+    summaries = {}
+
+    def add(metric, when, seconds, status=''):
+        key = (timezone.localdate(when), metric, status)
+        summaries.setdefault(key, DurationSummary()).add(seconds)
+
+    for db in get_ticket_databases():
+        _collect_status_changes(db, add)
+        _rebuild_first_responses(db, add)
+
+    with transaction.atomic():
+        DailyTicketMetric.objects.all().delete()
+        DailyTicketMetric.objects.bulk_create(
+            [
+                DailyTicketMetric(
+                    date=date, metric=metric, status=status,
+                    count=summary.count, total_seconds=summary.total_seconds,
+                    max_seconds=summary.max_seconds, histogram=summary.histogram,
+                )
+                for (date, metric, status), summary in summaries.items()
+            ],
+            batch_size=1000,
+        )
+    return len(summaries)
+
+
+def _collect_status_changes(db, add):
+    changes = (
+        TicketStatusChange.objects.using(db).order_by('ticket_id', 'changed_at', 'id')
+        .values_list('ticket_id', 'from_status', 'to_status', 'changed_at', 'ticket__created_at')
+    )
+    current_ticket = entered_at = None
+    for ticket_id, from_status, to_status, changed_at, created_at in changes.iterator():
+        if ticket_id != current_ticket:
+            current_ticket, entered_at = ticket_id, created_at
+        if from_status:
+            add(DailyTicketMetric.TIME_IN_STATUS, changed_at,
+                (changed_at - entered_at).total_seconds(), status=from_status)
+            if to_status == 'closed':
+                add(DailyTicketMetric.RESOLUTION, changed_at, (changed_at - created_at).total_seconds())
+        entered_at = changed_at
+
+
+def _rebuild_first_responses(db, add):
+    comments = (
+        Comment.objects.using(db).order_by('ticket_id', 'created_at', 'id')
+        .values_list('ticket_id', 'author_id', 'created_at',
+                     'ticket__created_by_id', 'ticket__assignee_id', 'ticket__created_at')
+    )
+    first_responses = []
+    answered_ticket = None
+    for ticket_id, author_id, created_at, created_by_id, assignee_id, ticket_created_at in comments.iterator():
+        if ticket_id == answered_ticket or author_id == (created_by_id or assignee_id):
+            continue
+        answered_ticket = ticket_id
+        first_responses.append(Ticket(pk=ticket_id, first_response_at=created_at))
+        add(DailyTicketMetric.FIRST_RESPONSE, created_at, (created_at - ticket_created_at).total_seconds())
+
+    with transaction.atomic(using=db):
+        Ticket.objects.using(db).update(first_response_at=None)
+        Ticket.objects.using(db).bulk_update(first_responses, ['first_response_at'], batch_size=1000)
+
+
+def default_range(days=30):
+    end = timezone.localdate()
+    return end - timedelta(days=days - 1), end
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-19 10:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_created_by(apps, schema_editor):
+    # Before auto-assignment every ticket was assigned to its creator.
+    Ticket = apps.get_model('ticket', 'Ticket')
+    Ticket.objects.using(schema_editor.connection.alias).filter(created_by__isnull=True).update(created_by=models.F('assignee'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticket', '0002_comment'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='created_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='created_tickets', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill_created_by, migrations.RunPython.noop),
+    ]
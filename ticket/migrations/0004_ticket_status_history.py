@@ -0,0 +1,71 @@
+# Generated by Django 5.1.4 on 2026-10-19 00:21
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_status_changes(apps, schema_editor):
+    # Transitions before this migration were not recorded. Approximate them
+    # with the creation and, for tickets that moved on, their last update.
+    Ticket = apps.get_model('ticket', 'Ticket')
+    TicketStatusChange = apps.get_model('ticket', 'TicketStatusChange')
+    db = schema_editor.connection.alias
+    changes = []
+    for ticket in Ticket.objects.using(db).iterator():
+        changes.append(TicketStatusChange(
+            ticket=ticket, from_status='', to_status='open', changed_at=ticket.created_at
+        ))
+        if ticket.status != 'open':
+            changes.append(TicketStatusChange(
+                ticket=ticket, from_status='open', to_status=ticket.status, changed_at=ticket.updated_at
+            ))
+    TicketStatusChange.objects.using(db).bulk_create(changes, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticket', '0003_ticket_created_by'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='first_response_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='DailyTicketMetric',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('metric', models.CharField(choices=[('first_response', 'Time to first response'), ('resolution', 'Resolution time'), ('time_in_status', 'Time in status')], max_length=50)),
+                ('status', models.CharField(blank=True, choices=[('open', 'Open'), ('in_progress', 'In Progress'), ('closed', 'Closed')], max_length=50)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total_seconds', models.FloatField(default=0)),
+                ('max_seconds', models.FloatField(default=0)),
+                ('histogram', models.JSONField(default=list)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('date', 'metric', 'status'), name='unique_daily_ticket_metric')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TicketStatusChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_status', models.CharField(blank=True, choices=[('open', 'Open'), ('in_progress', 'In Progress'), ('closed', 'Closed')], max_length=50)),
+                ('to_status', models.CharField(choices=[('open', 'Open'), ('in_progress', 'In Progress'), ('closed', 'Closed')], max_length=50)),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('changed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='status_changes', to=settings.AUTH_USER_MODEL)),
+                ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_changes', to='ticket.ticket')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ticket', 'changed_at'], name='ticket_tick_ticket__8a7617_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_status_changes, migrations.RunPython.noop),
+    ]
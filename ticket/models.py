@@ -1,23 +1,65 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 
 # Create your models here.
 
+STATUS_CHOICES = [
+    ('open', 'Open'),
+    ('in_progress', 'In Progress'),
+    ('closed', 'Closed'),
+]
+
+
+class ShardedQuerySet(models.QuerySet):
+    """
+    QuerySet for models spread over the ticket shards (see ticket/sharding.py).
+
+    ``create()`` without an explicit ``using()`` saves through the instance, so
+    the router picks the shard from the new row instead of falling back to the
+    default database.
+    """
+
+    def create(self, **kwargs):
+        if self._db is not None:
+            return super().create(**kwargs)
+        obj = self.model(**kwargs)
+        obj.save(force_insert=True)
+        return obj
+
+
 class Ticket(models.Model):
     title = models.CharField(max_length=200)
     description = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    status = models.CharField(max_length=50, choices=[
-        ('open', 'Open'),
-        ('in_progress', 'In Progress'),
-        ('closed', 'Closed'),
-    ], default='open')
+    status = models.CharField(max_length=50, choices=STATUS_CHOICES, default='open')
+    # Users live on the default database while tickets may live on a shard,
+    # so references to users are not enforced by the database.
+    # Staff member handling the ticket; cleared if their account is deleted
+    # so customer tickets are never deleted along with it.
     assignee = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        related_name='tickets',
+        null=True,
+        blank=True,
+        db_constraint=False
+    )
+    # The user who opened the ticket. ``assignee`` is chosen by the
+    # assignment scheduler (see ticket/assignment.py) and is usually staff.
+    created_by = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
-        related_name='tickets'
+        related_name='created_tickets',
+        null=True,
+        blank=True,
+        db_constraint=False
     )
+    # Set once, by the first comment from someone other than the creator.
+    first_response_at = models.DateTimeField(null=True, blank=True)
+
+    objects = ShardedQuerySet.as_manager()
 
     def __str__(self):
         return self.title
@@ -28,10 +70,125 @@ class Comment(models.Model):
     author = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         related_name='comments',
-        on_delete=models.PROTECT
+        on_delete=models.PROTECT,
+        db_constraint=False
     )
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ShardedQuerySet.as_manager()
+
+    def __str__(self):
+        return self.content
+
+
+class TicketStatusChange(models.Model):
+    """
+    Append-only log of ticket status transitions.
+
+    A row with an empty ``from_status`` marks the ticket's creation.
+    """
+    ticket = models.ForeignKey(Ticket, related_name='status_changes', on_delete=models.CASCADE)
+    from_status = models.CharField(max_length=50, choices=STATUS_CHOICES, blank=True)
+    to_status = models.CharField(max_length=50, choices=STATUS_CHOICES)
+    changed_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name='status_changes',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        db_constraint=False
+    )
+    changed_at = models.DateTimeField(default=timezone.now)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ticket', 'changed_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.ticket_id}: {self.from_status or "-"} -> {self.to_status}'
+
+
+class DailyTicketMetric(models.Model):
+    """
+    Pre-aggregated durations for one metric on one day (see ticket/metrics.py).
+
+    ``histogram`` holds counts per bucket of ``metrics.BUCKET_BOUNDS`` so
+    percentiles can be computed over any range of days without touching the
+    raw history.
+    """
+    FIRST_RESPONSE = 'first_response'
+    RESOLUTION = 'resolution'
+    TIME_IN_STATUS = 'time_in_status'
+    METRIC_CHOICES = [
+        (FIRST_RESPONSE, 'Time to first response'),
+        (RESOLUTION, 'Resolution time'),
+        (TIME_IN_STATUS, 'Time in status'),
+    ]
+
+    date = models.DateField()
+    metric = models.CharField(max_length=50, choices=METRIC_CHOICES)
+    # Only set for time_in_status.
+    status = models.CharField(max_length=50, choices=STATUS_CHOICES, blank=True)
+    count = models.PositiveIntegerField(default=0)
+    total_seconds = models.FloatField(default=0)
+    max_seconds = models.FloatField(default=0)
+    histogram = models.JSONField(default=list)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'metric', 'status'], name='unique_daily_ticket_metric'),
+        ]
+
+    def __str__(self):
+        return f'{self.date} {self.metric} {self.status}'.strip()
+
+
+class ShardPlacement(models.Model):
+    """
+    The shard holding the tickets (and their comments and history) opened by
+    a user. ``moving`` is set while the rebalancer copies them elsewhere.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='ticket_shard'
+    )
+    shard = models.CharField(max_length=100)
+    moving = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f'{self.user_id} -> {self.shard}'
+
+
+class TicketIdSequence(models.Model):
+    """
+    Next free primary key of a sharded model, handed out in blocks so ids stay
+    unique across shards.
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    next_value = models.BigIntegerField()
+
+    def __str__(self):
+        return f'{self.name}: {self.next_value}'
+
+
+class StaffLoad(models.Model):
+    """
+    Number of open/in_progress tickets assigned to a staff member, kept up to
+    date by the assignment scheduler (see ticket/assignment.py).
+    """
+    staff = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='ticket_load'
+    )
+    active_tickets = models.PositiveIntegerField(default=0)
+    last_assigned_at = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
-        return self.content
\ No newline at end of file
+        return f'{self.staff_id}: {self.active_tickets}'
@@ -1,24 +1,44 @@
 from rest_framework import serializers
-from .models import Ticket, Comment
+from .models import Ticket, Comment, TicketStatusChange
+from .sharding import find_ticket
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
 
 class TicketSerializer(serializers.ModelSerializer):
-    assignee_name = serializers.CharField(source='assignee.name', read_only=True)
-    assignee_username = serializers.CharField(source='assignee.username', read_only=True)
+    assignee_name = serializers.CharField(source='assignee.name', read_only=True, default=None)
+    assignee_username = serializers.CharField(source='assignee.username', read_only=True, default=None)
+    created_by_name = serializers.CharField(source='created_by.name', read_only=True, default=None)
+    created_by_username = serializers.CharField(source='created_by.username', read_only=True, default=None)
     created_at = serializers.DateTimeField(format='%Y-%m-%d %H:%M:%S', read_only=True)
     updated_at = serializers.DateTimeField(format='%Y-%m-%d %H:%M:%S', read_only=True)
+    first_response_at = serializers.DateTimeField(format='%Y-%m-%d %H:%M:%S', read_only=True)
 
     class Meta:
         model = Ticket
         fields = ['id', 'title', 'description', 'status', 'created_at', 'updated_at', 
-                  'assignee', 'assignee_name', 'assignee_username']
-        read_only_fields = ['assignee', 'created_at', 'updated_at']
+                  'assignee', 'assignee_name', 'assignee_username',
+                  'created_by', 'created_by_name', 'created_by_username', 'first_response_at']
+        read_only_fields = ['assignee', 'created_by', 'created_at', 'updated_at', 'first_response_at']
+
+
+class ShardedTicketField(serializers.PrimaryKeyRelatedField):
+    """
+    Ticket reference that is looked up on whichever shard holds the ticket,
+    among the tickets the requesting user may see.
+    """
+
+    def to_internal_value(self, data):
+        request = self.context.get('request')
+        ticket = find_ticket(data, getattr(request, 'user', None))
+        if ticket is None:
+            self.fail('does_not_exist', pk_value=data)
+        return ticket
 
 
 class CommentSerializer(serializers.ModelSerializer):
+    ticket = ShardedTicketField(queryset=Ticket.objects.all())
     author_name = serializers.CharField(source='author.name', read_only=True)
     author_username = serializers.CharField(source='author.username', read_only=True)
     created_at = serializers.DateTimeField(format='%Y-%m-%d %H:%M:%S', read_only=True)
@@ -27,3 +47,13 @@ class CommentSerializer(serializers.ModelSerializer):
         model = Comment
         fields = ['id', 'ticket', 'author', 'author_name', 'author_username', 'content', 'created_at']
         read_only_fields = ['id', 'author', 'created_at']
+
+
+class TicketStatusChangeSerializer(serializers.ModelSerializer):
+    changed_by_username = serializers.CharField(source='changed_by.username', read_only=True, default=None)
+    changed_at = serializers.DateTimeField(format='%Y-%m-%d %H:%M:%S', read_only=True)
+
+    class Meta:
+        model = TicketStatusChange
+        fields = ['id', 'ticket', 'from_status', 'to_status', 'changed_by', 'changed_by_username', 'changed_at']
+        read_only_fields = fields
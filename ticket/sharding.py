@@ -0,0 +1,437 @@
+"""
+Horizontal sharding of tickets, comments and status history.
+
+Every ticket belongs to the user who opened it (``created_by``, or
+``assignee`` for tickets that predate it), and all of that user's tickets,
+their comments and their status history live on one database listed in
+``TICKET_SHARDS``. That keeps every non-staff query on a single shard, while
+staff-wide listings fan out to all shards and are merged on
+``(-created_at, -id)`` cursors.
+
+Users are placed on a shard when they open their first ticket, using a
+consistent hash ring over ``TICKET_SHARDS``. The placement is stored in
+``ShardPlacement`` on the default database (together with users and the
+rollups), so adding a shard only moves the users whose ring position
+changed; ``rebalance()`` moves them one at a time while the site is up.
+
+Primary keys of sharded models come from ``TicketIdSequence`` in blocks, so
+ids are unique across shards and rows keep their id when they move.
+"""
+import base64
+import hashlib
+import heapq
+import threading
+import time
+from bisect import bisect
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, ProtectedError, Q
+from rest_framework.exceptions import APIException, NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .models import Comment, ShardPlacement, Ticket, TicketIdSequence, TicketStatusChange
+
+User = get_user_model()
+
+SHARDED_MODELS = (Ticket, Comment, TicketStatusChange)
+
+DEFAULT_DB = 'default'
+
+
+class ShardUnavailable(APIException):
+    status_code = 503
+    default_detail = 'These tickets are being moved to another database. Please retry shortly.'
+    default_code = 'shard_unavailable'
+
+
+def get_shards():
+    return list(getattr(settings, 'TICKET_SHARDS', [DEFAULT_DB]))
+
+
+def get_ticket_databases():
+    """
+    Every database that may hold tickets: the shards, plus the default
+    database, which keeps tickets from before sharding until they are
+    rebalanced.
+    """
+    shards = get_shards()
+    return shards if DEFAULT_DB in shards else [*shards, DEFAULT_DB]
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping user ids to shard aliases.
+    """
+
+    def __init__(self, shards, replicas=64):
+        self.shards = list(shards)
+        points = sorted(
+            (self._hash(f'{shard}#{i}'), shard)
+            for shard in self.shards
+            for i in range(replicas)
+        )
+        self._keys = [key for key, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+    def get(self, key):
+        i = bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._shards[i]
+
+
+_ring = None
+
+
+def get_ring():
+    global _ring
+    shards = get_shards()
+    if _ring is None or _ring.shards != shards:
+        _ring = HashRing(shards)
+    return _ring
+
+
+def owner_id(ticket):
+    return ticket.created_by_id or ticket.assignee_id
+
+
+def get_placement(user_id):
+    return ShardPlacement.objects.filter(user_id=user_id).first()
+
+
+def shard_for_user(user_id):
+    """
+    The shard holding ``user_id``'s tickets, placed or not.
+    """
+    placement = get_placement(user_id)
+    return placement.shard if placement else get_ring().get(user_id)
+
+
+def writable_shard_for_user(user_id):
+    """
+    Like ``shard_for_user`` but records the placement and refuses writes while
+    the user's tickets are being moved.
+    """
+    placement = get_placement(user_id)
+    if placement is None:
+        try:
+            placement, _ = ShardPlacement.objects.get_or_create(
+                user_id=user_id, defaults={'shard': get_ring().get(user_id)}
+            )
+        except IntegrityError:
+            placement = get_placement(user_id)
+    if placement.moving:
+        raise ShardUnavailable()
+    return placement.shard
+
+
+def check_writable(ticket):
+    placement = get_placement(owner_id(ticket))
+    if placement is not None and placement.moving:
+        raise ShardUnavailable()
+
+
+def find_ticket(pk, user=None):
+    """
+    Look a ticket up by id.
+
+    Non-staff users only see tickets they opened or are assigned to, which
+    live on their own shard. Otherwise every shard is searched; a ticket
+    found on more than one shard (mid-move) is read from its owner's shard.
+    """
+    try:
+        pk = int(pk)
+    except (TypeError, ValueError):
+        return None
+
+    if user is not None and not user.is_staff:
+        return (
+            Ticket.objects.using(shard_for_user(user.pk))
+            .filter(Q(created_by=user) | Q(assignee=user), pk=pk)
+            .first()
+        )
+
+    found = [
+        ticket for ticket in (Ticket.objects.using(db).filter(pk=pk).first() for db in get_ticket_databases())
+        if ticket is not None
+    ]
+    if len(found) > 1:
+        home = shard_for_user(owner_id(found[0]))
+        found = [ticket for ticket in found if ticket._state.db == home] or found
+    return found[0] if found else None
+
+
+class TicketShardRouter:
+    """
+    Database router sending sharded models to their owner's shard.
+
+    Everything else (users, sessions, placements, id sequences and metric
+    rollups) lives on the default database.
+    """
+
+    def _db(self, model, instance=None):
+        if model not in SHARDED_MODELS:
+            return DEFAULT_DB
+        if instance is None:
+            # Without an instance there is no way to tell the shard; callers
+            # pick one with using().
+            return None
+        if isinstance(instance, SHARDED_MODELS) and not instance._state.adding:
+            return instance._state.db
+        # New rows are placed by their owner even if assigning a related
+        # object (e.g. ``assignee``) already set ``_state.db`` to its shard.
+        if isinstance(instance, Ticket):
+            owner = owner_id(instance)
+            return shard_for_user(owner) if owner else instance._state.db
+        if isinstance(instance, (Comment, TicketStatusChange)):
+            # Only use a ticket that is already loaded; fetching it here would
+            # come back to the router.
+            if instance._meta.get_field('ticket').is_cached(instance):
+                return instance.ticket._state.db
+            return instance._state.db
+        if isinstance(instance, User):
+            return shard_for_user(instance.pk)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self._db(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Any database may become a shard, so a new one can be migrated
+        # before it is added to TICKET_SHARDS.
+        if app_label == 'ticket' and model_name in {m._meta.model_name for m in SHARDED_MODELS}:
+            return True
+        if app_label == 'ticket' and model_name is None:
+            # Data migrations pick their own database.
+            return True
+        return db == DEFAULT_DB
+
+
+class IdAllocator:
+    """
+    Hands out primary keys for sharded models from blocks reserved in
+    ``TicketIdSequence``, so each process only touches the sequence once per
+    ``block_size`` rows.
+
+    A block reserved inside a transaction on the default database is undone
+    if that transaction rolls back, so only the id needed right away is used
+    until then; the rest of the block is cached once the reservation commits.
+    """
+
+    def __init__(self, block_size=1000):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def next_id(self, model):
+        name = model._meta.label_lower
+        with self._lock:
+            next_id, end = self._blocks.get(name, (0, 0))
+            if next_id < end:
+                self._blocks[name] = (next_id + 1, end)
+                return next_id
+
+        start, end = self._reserve(model)
+        transaction.on_commit(partial(self._install, name, start + 1, end), using=DEFAULT_DB)
+        return start
+
+    def _install(self, name, next_id, end):
+        with self._lock:
+            current, current_end = self._blocks.get(name, (0, 0))
+            if current >= current_end:
+                self._blocks[name] = (next_id, end)
+
+    def _reserve(self, model):
+        name = model._meta.label_lower
+        with transaction.atomic(using=DEFAULT_DB):
+            reserved = TicketIdSequence.objects.filter(name=name).update(
+                next_value=F('next_value') + self.block_size
+            )
+            if not reserved:
+                # First use: continue after the highest id on any shard.
+                start = 1 + max(
+                    model.objects.using(db).aggregate(max_id=Max('pk'))['max_id'] or 0
+                    for db in get_ticket_databases()
+                )
+                try:
+                    with transaction.atomic(using=DEFAULT_DB):
+                        TicketIdSequence.objects.create(name=name, next_value=start + self.block_size)
+                    return start, start + self.block_size
+                except IntegrityError:
+                    TicketIdSequence.objects.filter(name=name).update(
+                        next_value=F('next_value') + self.block_size
+                    )
+            end = TicketIdSequence.objects.get(name=name).next_value
+        return end - self.block_size, end
+
+
+id_allocator = IdAllocator()
+
+
+def assign_id(sender, instance, raw=False, **kwargs):
+    if instance.pk is None and not raw:
+        instance.pk = id_allocator.next_id(sender)
+
+
+def user_deleting(sender, instance, **kwargs):
+    # The default database applies on_delete on its own; shards have no
+    # foreign keys to users, so mirror it there.
+    shards = [db for db in get_ticket_databases() if db != DEFAULT_DB]
+
+    # Comment.author is PROTECT: refuse before anything is deleted.
+    for db in shards:
+        comments = Comment.objects.using(db).filter(author=instance)
+        if comments.exists():
+            raise ProtectedError(
+                "Cannot delete some instances of model 'User' because they are "
+                "referenced through protected foreign keys: 'Comment.author'.",
+                set(comments),
+            )
+
+    for db in shards:
+        Ticket.objects.using(db).filter(_owner_filter(instance.pk)).delete()
+        Ticket.objects.using(db).filter(assignee=instance).update(assignee=None)
+        TicketStatusChange.objects.using(db).filter(changed_by=instance).update(changed_by=None)
+
+
+class ShardedCursorPagination:
+    """
+    Cursor pagination over several shards, newest first.
+
+    Each shard returns at most one page past the cursor; the pages are merged
+    on ``(created_at, id)`` and the cursor of the last row is handed back as
+    ``next``.
+    """
+    cursor_query_param = 'cursor'
+
+    def __init__(self, page_size=None):
+        self.page_size = page_size or settings.REST_FRAMEWORK.get('PAGE_SIZE', 20)
+
+    def encode_cursor(self, ticket):
+        value = f'{ticket.created_at.isoformat()}|{ticket.pk}'
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(created_at), int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor')
+
+    def paginate(self, querysets, request):
+        self.request = request
+        cursor = request.query_params.get(self.cursor_query_param)
+        pages = []
+        for queryset in querysets:
+            queryset = queryset.order_by('-created_at', '-id')
+            if cursor:
+                created_at, pk = self.decode_cursor(cursor)
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+                )
+            pages.append(list(queryset[:self.page_size + 1]))
+
+        merged = heapq.merge(*pages, key=lambda ticket: (ticket.created_at, ticket.pk), reverse=True)
+        # A ticket that is being moved can be on two shards at once.
+        rows = list(OrderedDict((ticket.pk, ticket) for ticket in merged).values())
+
+        page = rows[:self.page_size]
+        self.next_cursor = self.encode_cursor(page[-1]) if len(rows) > self.page_size else None
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': None,
+            'results': data,
+        })
+
+
+def _owner_filter(user_id):
+    return Q(created_by_id=user_id) | Q(created_by__isnull=True, assignee_id=user_id)
+
+
+def _copy(queryset, target):
+    # raw=True keeps created_at/updated_at instead of re-stamping them.
+    rows = list(queryset)
+    for row in rows:
+        row.save_base(raw=True, force_insert=True, using=target)
+    return rows
+
+
+def move_user(placement, target, grace_seconds=5):
+    """
+    Move a user's tickets, comments and history to ``target``.
+
+    Writes for the user are refused while ``moving`` is set; the grace period
+    lets requests that read the old placement finish before the copy starts.
+    Reads keep using the source until the placement is switched.
+    """
+    source = placement.shard
+    placement.moving = True
+    placement.save(update_fields=['moving'])
+    try:
+        time.sleep(grace_seconds)
+        tickets = Ticket.objects.using(source).filter(_owner_filter(placement.user_id))
+        with transaction.atomic(using=target):
+            ticket_ids = [ticket.pk for ticket in _copy(tickets, target)]
+            _copy(Comment.objects.using(source).filter(ticket_id__in=ticket_ids), target)
+            _copy(TicketStatusChange.objects.using(source).filter(ticket_id__in=ticket_ids), target)
+    except BaseException:
+        placement.moving = False
+        placement.save(update_fields=['moving'])
+        raise
+
+    placement.shard = target
+    placement.moving = False
+    placement.save(update_fields=['shard', 'moving'])
+
+    # The rows live on in ``target``, so remove the source copies without
+    # delete signals (which would e.g. lower the assignee's load counter).
+    with transaction.atomic(using=source):
+        for model in (Comment, TicketStatusChange):
+            model.objects.using(source).filter(ticket_id__in=ticket_ids)._raw_delete(source)
+        Ticket.objects.using(source).filter(pk__in=ticket_ids)._raw_delete(source)
+    return len(ticket_ids)
+
+
+def rebalance(grace_seconds=5, dry_run=False, log=None):
+    """
+    Move every placed user whose ring position is not their current shard.
+    Returns the number of users moved (or to be moved, with ``dry_run``).
+    """
+    ring = get_ring()
+    moved = 0
+    for placement in ShardPlacement.objects.order_by('user_id').iterator():
+        target = ring.get(placement.user_id)
+        if placement.shard == target:
+            continue
+        moved += 1
+        if dry_run:
+            if log:
+                log(f'user {placement.user_id}: {placement.shard} -> {target}')
+            continue
+        count = move_user(placement, target, grace_seconds=grace_seconds)
+        if log:
+            log(f'user {placement.user_id}: moved {count} tickets to {target}')
+    return moved
@@ -1,3 +1,777 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+from django.db.models import ProtectedError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+
+from .assignment import (
+    AssignmentStrategy, LeastLoadedStrategy, LoadIndex, RoundRobinStrategy, WeightedStrategy,
+    create_assigned_ticket, get_strategy,
+)
+from . import metrics, sharding
+from .metrics import DurationSummary
+from .models import Comment, DailyTicketMetric, ShardPlacement, StaffLoad, Ticket, TicketIdSequence, TicketStatusChange
+from .serializers import TicketSerializer
+from .sharding import HashRing, IdAllocator, ShardedCursorPagination, ShardUnavailable
+from .views import TicketViewSet
+
+User = get_user_model()
+
+# Tests outside ShardingTests keep every ticket on the default database, even
+# when TICKET_SHARD_COUNT is set.
+unsharded = override_settings(TICKET_SHARDS=['default'])
+
+
+class FreshLoadIndexMixin:
+    """
+    Give each test its own process-wide load index: the cached counts and
+    unwritten changes of the shared one would outlive the test's rollback.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.load_index = LoadIndex()
+        for target in ('ticket.assignment.load_index', 'ticket.views.load_index'):
+            patcher = mock.patch(target, self.load_index)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+def make_user(username, **kwargs):
+    return User.objects.create_user(username=username, password='secret', name=username.title(), **kwargs)
+
+
+def pick(strategy, loads, times):
+    """
+    Let ``strategy`` choose ``times`` times, updating the loads like ``LoadIndex.acquire``.
+    """
+    chosen = []
+    now = timezone.now()
+    for i in range(times):
+        load = strategy.choose(loads)
+        load.active_tickets += 1
+        load.last_assigned_at = now + timedelta(seconds=i)
+        chosen.append(load.staff_id)
+    return chosen
+
+
+class AssignmentStrategyTests(SimpleTestCase):
+    def test_least_loaded_prefers_lowest_id_on_ties(self):
+        loads = [StaffLoad(staff_id=3, active_tickets=2), StaffLoad(staff_id=1, active_tickets=2),
+                 StaffLoad(staff_id=2, active_tickets=5)]
+        self.assertEqual(LeastLoadedStrategy().choose(loads).staff_id, 1)
+        self.assertEqual(pick(LeastLoadedStrategy(), loads, 3), [1, 3, 1])
+
+    def test_round_robin_wraps_around(self):
+        loads = [StaffLoad(staff_id=staff_id, active_tickets=10 - staff_id) for staff_id in (1, 2, 3)]
+        self.assertEqual(pick(RoundRobinStrategy(), loads, 7), [1, 2, 3, 1, 2, 3, 1])
+
+    def test_round_robin_continues_after_last_assigned(self):
+        now = timezone.now()
+        loads = [
+            StaffLoad(staff_id=1, last_assigned_at=now - timedelta(minutes=1)),
+            StaffLoad(staff_id=2, last_assigned_at=now),
+            StaffLoad(staff_id=3, last_assigned_at=now - timedelta(minutes=2)),
+        ]
+        self.assertEqual(pick(RoundRobinStrategy(), loads, 3), [3, 1, 2])
+
+    def test_weighted_splits_by_capacity(self):
+        # Staff 3 has no entry and gets the default weight of 1.
+        loads = [StaffLoad(staff_id=staff_id) for staff_id in (1, 2, 3)]
+        chosen = pick(WeightedStrategy({'1': 2, 2: 0}), loads, 6)
+        self.assertEqual(chosen.count(1), 4)
+        self.assertEqual(chosen.count(3), 2)
+        self.assertNotIn(2, chosen)
+
+    def test_weighted_zero_weight_is_last_resort(self):
+        loads = [StaffLoad(staff_id=2, active_tickets=7), StaffLoad(staff_id=5, active_tickets=3)]
+        self.assertEqual(WeightedStrategy({2: 0, 5: 0}).choose(loads).staff_id, 5)
+
+
+class IncompleteStrategy(AssignmentStrategy):
+    pass
+
+
+class GetStrategyTests(SimpleTestCase):
+    def test_builtin_and_dotted_path(self):
+        self.assertIsInstance(get_strategy('round_robin'), RoundRobinStrategy)
+        self.assertIsInstance(get_strategy('ticket.assignment.WeightedStrategy'), WeightedStrategy)
+        with override_settings(TICKET_ASSIGNMENT_STRATEGY='least_loaded'):
+            self.assertIsInstance(get_strategy(), LeastLoadedStrategy)
+
+    def test_broken_strategy_fails_when_built(self):
+        with self.assertRaises(TypeError):
+            get_strategy('ticket.tests.IncompleteStrategy')
+        with self.assertRaises(ImproperlyConfigured):
+            get_strategy('ticket.models.Ticket')
+        with self.assertRaises(ImportError):
+            get_strategy('ticket.assignment.Missing')
+
+@unsharded
+class LoadIndexTests(FreshLoadIndexMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.index = LoadIndex()
+        self.requester = make_user('requester')
+        self.staff = make_user('staff', is_staff=True)
+
+    def create_ticket(self, status='open', assignee=None):
+        return Ticket.objects.create(
+            title='Printer', description='Jammed', status=status,
+            assignee=assignee or self.staff, created_by=self.requester,
+        )
+
+    def test_counts_existing_active_tickets(self):
+        self.create_ticket('open')
+        self.create_ticket('in_progress')
+        self.create_ticket('closed')
+        make_user('former', is_staff=True, is_active=False)
+
+        self.assertEqual(self.index.snapshot(), {self.staff.pk: 2})
+
+    def test_acquire_and_release(self):
+        other = make_user('other', is_staff=True)
+        strategy = LeastLoadedStrategy()
+
+        self.assertEqual(self.index.acquire(strategy), self.staff.pk)
+        self.assertEqual(self.index.acquire(strategy), other.pk)
+        self.assertEqual(self.index.acquire(strategy), self.staff.pk)
+        self.assertEqual(self.index.snapshot(), {self.staff.pk: 2, other.pk: 1})
+
+        self.index.release(other.pk)
+        self.index.release(other.pk)
+        self.assertEqual(self.index.snapshot(), {self.staff.pk: 2, other.pk: 0})
+
+    def test_changes_are_written_on_commit(self):
+        self.index.acquire(LeastLoadedStrategy())
+        self.index.acquire(LeastLoadedStrategy())
+        self.index.release(self.staff.pk)
+        self.assertEqual(StaffLoad.objects.get(pk=self.staff.pk).active_tickets, 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.index.sync()
+        load = StaffLoad.objects.get(pk=self.staff.pk)
+        self.assertEqual(load.active_tickets, 1)
+        self.assertIsNotNone(load.last_assigned_at)
+
+    def test_rolled_back_sync_keeps_changes(self):
+        self.index.acquire(LeastLoadedStrategy())
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    self.index.sync()
+                    raise RuntimeError
+        self.assertEqual(callbacks, [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.index.sync()
+        self.assertEqual(StaffLoad.objects.get(pk=self.staff.pk).active_tickets, 1)
+
+    def test_counters_are_shared_between_indexes(self):
+        other_process = LoadIndex(sync_seconds=0)
+        self.assertEqual(other_process.snapshot(), {self.staff.pk: 0})
+
+        self.index.acquire(LeastLoadedStrategy())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.index.sync()
+        self.assertEqual(other_process.snapshot(), {self.staff.pk: 1})
+        self.assertEqual(other_process.acquire(LeastLoadedStrategy()), self.staff.pk)
+        self.assertEqual(other_process.snapshot(), {self.staff.pk: 2})
+
+    def test_record_transition(self):
+        self.index.acquire(LeastLoadedStrategy())
+
+        self.index.record_transition(self.staff.pk, 'open', 'in_progress')
+        self.assertEqual(self.index.snapshot(), {self.staff.pk: 1})
+        self.index.record_transition(self.staff.pk, 'in_progress', 'closed')
+        self.assertEqual(self.index.snapshot(), {self.staff.pk: 0})
+        self.index.record_transition(self.staff.pk, 'closed', 'open')
+        self.assertEqual(self.index.snapshot(), {self.staff.pk: 1})
+        self.index.record_transition(None, 'closed', 'open')
+
+    def test_no_active_staff(self):
+        self.staff.is_active = False
+        self.staff.save()
+        self.assertIsNone(self.index.acquire(LeastLoadedStrategy()))
+
+    def test_new_staff_is_picked_up(self):
+        self.assertEqual(self.index.snapshot(), {self.staff.pk: 0})
+        self.assertEqual(self.load_index.snapshot(), {self.staff.pk: 0})
+        self.requester.is_staff = True
+        self.requester.save()
+
+        self.assertIn(self.requester.pk, self.load_index.snapshot())
+
+    def test_deleting_ticket_frees_slot(self):
+        ticket = self.create_ticket('open')
+        closed = self.create_ticket('closed')
+        self.assertEqual(self.load_index.snapshot(), {self.staff.pk: 1})
+
+        closed.delete()
+        self.assertEqual(self.load_index.snapshot(), {self.staff.pk: 1})
+        ticket.delete()
+        self.assertEqual(self.load_index.snapshot(), {self.staff.pk: 0})
+
+    def test_create_assigned_ticket_corrects_status(self):
+        serializer = TicketSerializer(data={'title': 'VPN', 'description': 'Down', 'status': 'closed'})
+        serializer.is_valid(raise_exception=True)
+        ticket = create_assigned_ticket(serializer, self.requester, index=self.index, strategy=LeastLoadedStrategy())
+
+        self.assertEqual(ticket.assignee, self.staff)
+        self.assertEqual(ticket.created_by, self.requester)
+        self.assertEqual(self.index.snapshot(), {self.staff.pk: 0})
+
+    def test_create_assigned_ticket_releases_slot_on_rollback(self):
+        def fail(ticket):
+            raise RuntimeError('history unavailable')
+
+        serializer = TicketSerializer(data={'title': 'VPN', 'description': 'Down'})
+        serializer.is_valid(raise_exception=True)
+        with self.assertRaises(RuntimeError):
+            create_assigned_ticket(
+                serializer, self.requester, on_created=fail, index=self.index, strategy=LeastLoadedStrategy()
+            )
+
+        self.assertFalse(Ticket.objects.exists())
+        self.assertEqual(self.index.snapshot(), {self.staff.pk: 0})
+
+
+@unsharded
+class TicketAssignmentApiTests(FreshLoadIndexMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.requester = make_user('requester')
+        self.client.force_authenticate(self.requester)
+
+    def create_ticket(self):
+        response = self.client.post('/api/tickets/', {'title': 'Laptop', 'description': 'No power'})
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data
+
+    def test_falls_back_to_creator_without_staff(self):
+        ticket = self.create_ticket()
+        self.assertEqual(ticket['assignee'], self.requester.pk)
+        self.assertEqual(ticket['created_by'], self.requester.pk)
+
+    def test_assigns_to_staff_and_requester_keeps_access(self):
+        staff = make_user('staff', is_staff=True)
+        ticket = self.create_ticket()
+        self.assertEqual(ticket['assignee'], staff.pk)
+        self.assertEqual(ticket['created_by'], self.requester.pk)
+
+        response = self.client.get('/api/tickets/')
+        self.assertEqual([t['id'] for t in response.data['results']], [ticket['id']])
+        response = self.client.get(f'/api/tickets/{ticket["id"]}/')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/api/comments/', {'ticket': ticket['id'], 'content': 'Any news?'})
+        self.assertEqual(response.status_code, 201, response.data)
+
+        self.client.force_authenticate(make_user('stranger'))
+        response = self.client.get(f'/api/tickets/{ticket["id"]}/')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post('/api/comments/', {'ticket': ticket['id'], 'content': 'Me too'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ticket', response.data)
+
+    def test_deleting_staff_keeps_tickets(self):
+        staff = make_user('staff', is_staff=True)
+        ticket = self.create_ticket()
+        staff.delete()
+
+        self.assertIsNone(Ticket.objects.get(pk=ticket['id']).assignee)
+        response = self.client.get(f'/api/tickets/{ticket["id"]}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['assignee_name'])
+
+
+class DurationSummaryTests(SimpleTestCase):
+    def test_empty(self):
+        summary = DurationSummary()
+        self.assertIsNone(summary.percentile(50))
+        self.assertEqual(summary.as_dict()['p99_seconds'], None)
+        self.assertEqual(summary.as_dict()['count'], 0)
+
+    def test_percentile_interpolates_within_bucket(self):
+        summary = DurationSummary()
+        summary.add(100)  # bucket (85, 101], capped at the maximum
+        self.assertAlmostEqual(summary.percentile(50), 92.5)
+        self.assertAlmostEqual(summary.percentile(100), 100)
+
+    def test_percentiles_are_ordered_and_bounded(self):
+        summary = DurationSummary()
+        for seconds in range(0, 86400, 97):
+            summary.add(seconds)
+        values = [summary.percentile(p) for p in (1, 50, 90, 99, 100)]
+        self.assertEqual(values, sorted(values))
+        self.assertLessEqual(values[-1], summary.max_seconds)
+        # Buckets are about 19% wide, so the median is close to the true one.
+        self.assertAlmostEqual(values[1], 43200, delta=43200 * 0.19)
+
+    def test_merge(self):
+        first, second = DurationSummary(), DurationSummary()
+        first.add(10)
+        first.add(-5)  # clock skew counts as zero
+        second.add(500)
+
+        first.merge(second)
+        self.assertEqual(first.count, 3)
+        self.assertEqual(first.total_seconds, 510)
+        self.assertEqual(first.max_seconds, 500)
+        self.assertEqual(sum(first.histogram), 3)
+        self.assertEqual(first.percentile(100), 500)
+        self.assertEqual(second.count, 1)
+
+
+@unsharded
+class TicketMetricsTests(FreshLoadIndexMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.requester = make_user('requester')
+        self.staff = make_user('staff', is_staff=True)
+        self.ticket = Ticket.objects.create(
+            title='Email', description='Bouncing', assignee=self.staff, created_by=self.requester
+        )
+        metrics.record_ticket_created(self.ticket, self.requester)
+        self.created_at = self.ticket.created_at
+
+    def change_status(self, new_status, minutes):
+        old_status = self.ticket.status
+        self.ticket.status = new_status
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.ticket.save()
+                metrics.record_status_change(
+                    self.ticket, old_status, new_status, self.staff,
+                    when=self.created_at + timedelta(minutes=minutes),
+                )
+
+    def comment(self, author, minutes):
+        comment = Comment.objects.create(ticket=self.ticket, author=author, content='...')
+        Comment.objects.filter(pk=comment.pk).update(created_at=self.created_at + timedelta(minutes=minutes))
+        comment.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            metrics.record_comment(comment)
+        self.ticket.refresh_from_db()
+
+    def rollup(self, metric, status=''):
+        return DailyTicketMetric.objects.get(metric=metric, status=status)
+
+    def test_record_status_change(self):
+        self.change_status('in_progress', 10)
+        self.change_status('closed', 40)
+
+        self.assertEqual(
+            list(self.ticket.status_changes.order_by('changed_at').values_list('from_status', 'to_status')),
+            [('', 'open'), ('open', 'in_progress'), ('in_progress', 'closed')],
+        )
+        self.assertEqual(self.rollup(DailyTicketMetric.TIME_IN_STATUS, 'open').total_seconds, 600)
+        self.assertEqual(self.rollup(DailyTicketMetric.TIME_IN_STATUS, 'in_progress').total_seconds, 1800)
+        resolution = self.rollup(DailyTicketMetric.RESOLUTION)
+        self.assertEqual((resolution.count, resolution.total_seconds), (1, 2400))
+
+    def test_unchanged_status_is_not_recorded(self):
+        self.assertIsNone(metrics.record_status_change(self.ticket, 'open', 'open'))
+        self.assertEqual(self.ticket.status_changes.count(), 1)
+
+    def test_rolled_back_change_skips_rollups(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    metrics.record_status_change(self.ticket, 'open', 'closed', self.staff)
+                    raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertFalse(DailyTicketMetric.objects.exists())
+        self.assertEqual(self.ticket.status_changes.count(), 1)
+
+    def test_first_response_recorded_once(self):
+        self.comment(self.requester, 1)
+        self.assertFalse(DailyTicketMetric.objects.exists())
+
+        self.comment(self.staff, 5)
+        self.comment(make_user('colleague', is_staff=True), 7)
+
+        self.ticket.refresh_from_db()
+        self.assertEqual(self.ticket.first_response_at, self.created_at + timedelta(minutes=5))
+        first_response = self.rollup(DailyTicketMetric.FIRST_RESPONSE)
+        self.assertEqual((first_response.count, first_response.total_seconds), (1, 300))
+
+    def test_rebuild_matches_incremental_rollups(self):
+        self.comment(self.requester, 1)
+        self.comment(self.staff, 3)
+        self.change_status('in_progress', 10)
+        self.change_status('open', 25)
+        self.change_status('closed', 65)
+        incremental = self.rollups()
+        first_response_at = Ticket.objects.get(pk=self.ticket.pk).first_response_at
+
+        Ticket.objects.update(first_response_at=None)
+        DailyTicketMetric.objects.all().delete()
+        self.assertEqual(metrics.rebuild_rollups(), len(incremental))
+
+        self.assertEqual(self.rollups(), incremental)
+        self.assertEqual(Ticket.objects.get(pk=self.ticket.pk).first_response_at, first_response_at)
+
+    def rollups(self):
+        return {
+            (row.date, row.metric, row.status): (row.count, round(row.total_seconds, 3), row.max_seconds, row.histogram)
+            for row in DailyTicketMetric.objects.all()
+        }
+
+
+@unsharded
+class TicketMetricsApiTests(FreshLoadIndexMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.staff = make_user('staff', is_staff=True)
+        self.client.force_authenticate(self.staff)
+
+    def test_report(self):
+        requester = make_user('requester')
+        self.client.force_authenticate(requester)
+        with self.captureOnCommitCallbacks(execute=True):
+            ticket = self.client.post('/api/tickets/', {'title': 'Wifi', 'description': 'Slow'}).data
+        self.client.force_authenticate(self.staff)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f'/api/tickets/{ticket["id"]}/update_status/', {'status': 'closed'})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['resolution']['count'], 1)
+        self.assertEqual(response.data['time_in_status']['open']['count'], 1)
+        self.assertEqual(response.data['first_response']['count'], 0)
+
+        response = self.client.get(f'/api/tickets/{ticket["id"]}/history/')
+        self.assertEqual([c['to_status'] for c in response.data], ['open', 'closed'])
+        self.assertEqual(response.data[1]['changed_by_username'], 'staff')
+
+    def test_history_loads_users_once(self):
+        requester = make_user('requester')
+        ticket = Ticket.objects.create(title='Wifi', description='Slow', created_by=requester)
+        metrics.record_ticket_created(ticket, requester)
+        for i, to_status in enumerate(['in_progress', 'open', 'closed']):
+            changed_by = make_user(f'agent{i}', is_staff=True)
+            metrics.record_status_change(ticket, ticket.status, to_status, changed_by)
+            ticket.status = to_status
+
+        # The ticket, its changes and their users.
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/api/tickets/{ticket.pk}/history/')
+        self.assertEqual(
+            [change['changed_by_username'] for change in response.data],
+            ['requester', 'agent0', 'agent1', 'agent2'],
+        )
+
+    def test_concurrent_status_changes_count_once(self):
+        requester = make_user('requester')
+        ticket = Ticket.objects.create(title='Wifi', description='Slow', assignee=self.staff, created_by=requester)
+        metrics.record_ticket_created(ticket, requester)
+        self.assertEqual(self.load_index.snapshot(), {self.staff.pk: 1})
+
+        for url in (f'/api/tickets/{ticket.pk}/update_status/', f'/api/tickets/{ticket.pk}/'):
+            # Both requests read the ticket while it was still open.
+            stale = [Ticket.objects.get(pk=ticket.pk), Ticket.objects.get(pk=ticket.pk)]
+            for instance in stale:
+                with mock.patch.object(TicketViewSet, 'get_object', return_value=instance):
+                    with self.captureOnCommitCallbacks(execute=True):
+                        response = self.client.patch(url, {'status': 'closed'})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data['status'], 'closed')
+
+            self.assertEqual(ticket.status_changes.filter(to_status='closed').count(), 1)
+            self.assertEqual(DailyTicketMetric.objects.get(metric=DailyTicketMetric.RESOLUTION).count, 1)
+            self.assertEqual(self.load_index.snapshot(), {self.staff.pk: 0})
+
+            Ticket.objects.filter(pk=ticket.pk).update(status='open')
+            ticket.status_changes.filter(to_status='closed').delete()
+            DailyTicketMetric.objects.all().delete()
+            self.load_index.adjust(self.staff.pk, 1)
+
+    def test_explicit_range(self):
+        response = self.client.get('/api/metrics/', {'start': '2024-01-01', 'end': '2024-01-31'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['start'], response.data['end']), ('2024-01-01', '2024-01-31'))
+
+    def test_invalid_dates(self):
+        for params in ({'start': 'yesterday'}, {'end': '2024-02-30'}, {'start': '2024-13-01'}):
+            response = self.client.get('/api/metrics/', params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_start_after_end(self):
+        response = self.client.get('/api/metrics/', {'start': '2024-02-01', 'end': '2024-01-01'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_staff_only(self):
+        self.client.force_authenticate(make_user('requester'))
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        self.client.force_authenticate(None)
+        self.assertIn(self.client.get('/api/metrics/').status_code, (401, 403))
+
+
+@unsharded
+class StaffTicketListTests(FreshLoadIndexMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.staff = make_user('staff', is_staff=True)
+        self.client.force_authenticate(self.staff)
+
+    def test_staff_queryset_is_empty(self):
+        Ticket.objects.create(title='Disk', description='Full', created_by=make_user('requester'))
+        view = TicketViewSet(request=Request(APIRequestFactory().get('/api/tickets/')))
+        view.request.user = self.staff
+        self.assertFalse(view.get_queryset().exists())
+
+    def test_browsable_api(self):
+        ticket = Ticket.objects.create(title='Disk', description='Full', created_by=make_user('requester'))
+        response = self.client.get('/api/tickets/', HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(f'/api/tickets/{ticket.pk}/', HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, 200)
+
+
+class HashRingTests(SimpleTestCase):
+    def test_stable_when_adding_a_shard(self):
+        before = HashRing(['shard0', 'shard1'])
+        after = HashRing(['shard0', 'shard1', 'shard2'])
+        self.assertEqual(HashRing(['shard0', 'shard1']).get(42), before.get(42))
+
+        moved = [key for key in range(3000) if before.get(key) != after.get(key)]
+        # Only keys taken over by the new shard move, about a third of them.
+        self.assertTrue(all(after.get(key) == 'shard2' for key in moved))
+        self.assertAlmostEqual(len(moved) / 3000, 1 / 3, delta=0.1)
+        self.assertEqual({before.get(key) for key in range(3000)}, {'shard0', 'shard1'})
+
+
+@unsharded
+class IdAllocatorTests(TestCase):
+    def test_rolled_back_block_is_not_reused(self):
+        allocator = IdAllocator(block_size=10)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                first = allocator.next_id(Ticket)
+                raise RuntimeError
+        # The reservation was undone, so the same block is reserved again.
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(allocator.next_id(Ticket), first)
+        with self.assertNumQueries(0):
+            self.assertEqual(allocator.next_id(Ticket), first + 1)
+        self.assertEqual(TicketIdSequence.objects.get().next_value, first + 10)
+
+
+@override_settings(TICKET_SHARDS=['shard0', 'shard1'])
+class ShardingTests(FreshLoadIndexMixin, APITestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        super().setUp()
+        self.staff = make_user('staff', is_staff=True)
+        self.owners = {}
+        i = 0
+        while len(self.owners) < 2:
+            user = make_user(f'customer{i}')
+            self.owners.setdefault(sharding.get_ring().get(user.pk), user)
+            i += 1
+
+    def create_ticket(self, shard, **kwargs):
+        return Ticket.objects.create(
+            title='Invoice', description='Wrong amount', created_by=self.owners[shard], **kwargs
+        )
+
+    def test_router_keeps_rows_on_owner_shard(self):
+        ticket = self.create_ticket('shard1', assignee=self.staff)
+        comment = Comment.objects.create(ticket=ticket, author=self.staff, content='Looking')
+        other = self.create_ticket('shard0')
+
+        self.assertEqual(ticket._state.db, 'shard1')
+        self.assertEqual(comment._state.db, 'shard1')
+        self.assertEqual(other._state.db, 'shard0')
+        self.assertFalse(Ticket.objects.using('default').exists())
+        self.assertNotEqual(ticket.pk, other.pk)
+        self.assertEqual(Ticket.objects.using('shard1').get().comments.get(), comment)
+
+    def test_api_create_places_owner(self):
+        owner = self.owners['shard1']
+        self.client.force_authenticate(owner)
+        ticket = self.client.post('/api/tickets/', {'title': 'Login', 'description': 'Locked out'}).data
+
+        self.assertEqual(ShardPlacement.objects.get(user=owner).shard, 'shard1')
+        self.assertEqual(Ticket.objects.using('shard1').get().pk, ticket['id'])
+        self.assertEqual(TicketStatusChange.objects.using('shard1').get().ticket_id, ticket['id'])
+        self.assertEqual(ticket['assignee'], self.staff.pk)
+
+        response = self.client.get(f'/api/tickets/{ticket["id"]}/history/')
+        self.assertEqual(response.data[0]['changed_by_username'], owner.username)
+
+    def test_find_ticket(self):
+        ticket = self.create_ticket('shard1')
+        self.assertEqual(sharding.find_ticket(ticket.pk), ticket)
+        self.assertEqual(sharding.find_ticket(str(ticket.pk), self.staff), ticket)
+        self.assertEqual(sharding.find_ticket(ticket.pk, self.owners['shard1']), ticket)
+        self.assertIsNone(sharding.find_ticket(ticket.pk, self.owners['shard0']))
+        self.assertIsNone(sharding.find_ticket('abc'))
+
+    def test_pagination_merges_shards_newest_first(self):
+        now = timezone.now()
+        for i, shard in enumerate(['shard0', 'shard1', 'shard1', 'shard0', 'shard1', 'shard0']):
+            ticket = self.create_ticket(shard)
+            # Two tickets per timestamp, so ties are broken by id.
+            Ticket.objects.using(shard).filter(pk=ticket.pk).update(created_at=now - timedelta(minutes=i // 2))
+        expected = [
+            ticket.pk for ticket in sorted(
+                [*Ticket.objects.using('shard0'), *Ticket.objects.using('shard1')],
+                key=lambda ticket: (ticket.created_at, ticket.pk), reverse=True,
+            )
+        ]
+
+        seen, cursor = [], None
+        factory = APIRequestFactory()
+        while True:
+            paginator = ShardedCursorPagination(page_size=4)
+            request = Request(factory.get('/api/tickets/', {'cursor': cursor} if cursor else {}))
+            page = paginator.paginate([Ticket.objects.using(db) for db in ('shard0', 'shard1')], request)
+            seen += [ticket.pk for ticket in page]
+            if paginator.next_cursor is None:
+                self.assertIsNone(paginator.get_next_link())
+                break
+            cursor = parse_qs(urlparse(paginator.get_next_link()).query)['cursor'][0]
+            self.assertEqual(cursor, paginator.next_cursor)
+
+        self.assertEqual(seen, expected)
+        with self.assertRaises(NotFound):
+            paginator.decode_cursor('not-a-cursor')
+
+    def test_staff_list_spans_shards(self):
+        tickets = [self.create_ticket('shard0'), self.create_ticket('shard1')]
+        self.client.force_authenticate(self.staff)
+        response = self.client.get('/api/tickets/')
+        self.assertEqual({t['id'] for t in response.data['results']}, {t.pk for t in tickets})
+        self.assertIsNone(response.data['next'])
+
+    def test_list_loads_users_once(self):
+        def list_tickets(user):
+            self.client.force_authenticate(user)
+            with CaptureQueriesContext(connections['default']) as queries:
+                response = self.client.get('/api/tickets/')
+            self.assertEqual(response.status_code, 200)
+            return response.data['results'], len(queries)
+
+        owner = self.owners['shard1']
+        self.create_ticket('shard0', assignee=self.staff)
+        self.create_ticket('shard1', assignee=self.staff)
+        _, staff_queries = list_tickets(self.staff)
+        _, owner_queries = list_tickets(owner)
+
+        for i in range(4):
+            self.create_ticket(('shard0', 'shard1')[i % 2], assignee=make_user(f'agent{i}', is_staff=True))
+        results, queries = list_tickets(self.staff)
+        self.assertEqual(queries, staff_queries)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(results[-1]['assignee_username'], 'staff')
+        self.assertEqual(results[0]['assignee_username'], 'agent3')
+        self.assertEqual(results[0]['created_by_username'], owner.username)
+
+        results, queries = list_tickets(owner)
+        self.assertEqual(queries, owner_queries)
+        self.assertEqual(len(results), 3)
+        self.assertEqual({t['created_by_username'] for t in results}, {owner.username})
+
+    def test_move_user(self):
+        owner = self.owners['shard0']
+        ShardPlacement.objects.create(user=owner, shard='shard0')
+        ticket = self.create_ticket('shard0', assignee=self.staff)
+        comment = Comment.objects.create(ticket=ticket, author=self.staff, content='On it')
+        metrics.record_ticket_created(ticket, owner)
+        loads = self.load_index.snapshot()
+        self.assertEqual(loads, {self.staff.pk: 1})
+
+        placement = ShardPlacement.objects.get(user=owner)
+        self.assertEqual(sharding.move_user(placement, 'shard1', grace_seconds=0), 1)
+        self.assertEqual(self.load_index.snapshot(), loads)
+
+        placement.refresh_from_db()
+        self.assertEqual((placement.shard, placement.moving), ('shard1', False))
+        self.assertFalse(Ticket.objects.using('shard0').exists())
+        self.assertFalse(Comment.objects.using('shard0').exists())
+        moved = Ticket.objects.using('shard1').get()
+        self.assertEqual((moved.pk, moved.created_at), (ticket.pk, ticket.created_at))
+        self.assertEqual(moved.comments.get().pk, comment.pk)
+        self.assertEqual(moved.status_changes.count(), 1)
+        self.assertEqual(sharding.find_ticket(ticket.pk, owner), moved)
+
+    def test_writes_refused_while_moving(self):
+        owner = self.owners['shard0']
+        ticket = self.create_ticket('shard0')
+        ShardPlacement.objects.create(user=owner, shard='shard0', moving=True)
+
+        with self.assertRaises(ShardUnavailable):
+            sharding.writable_shard_for_user(owner.pk)
+        self.client.force_authenticate(owner)
+        response = self.client.post('/api/tickets/', {'title': 'Again', 'description': 'Still broken'})
+        self.assertEqual(response.status_code, 503)
+        response = self.client.post('/api/comments/', {'ticket': ticket.pk, 'content': 'Hello?'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.client.get(f'/api/tickets/{ticket.pk}/').status_code, 200)
+
+    def test_rebalance(self):
+        # Placed before shard1 existed.
+        owner = self.owners['shard1']
+        ShardPlacement.objects.create(user=owner, shard='shard0')
+        for status in ('open', 'in_progress', 'closed'):
+            Ticket.objects.using('shard0').create(
+                title='Old', description='Placed early', status=status, created_by=owner, assignee=self.staff
+            )
+        ShardPlacement.objects.create(user=self.owners['shard0'], shard='shard0')
+        self.create_ticket('shard0')
+        loads = self.load_index.snapshot()
+        self.assertEqual(loads, {self.staff.pk: 2})
+
+        self.assertEqual(sharding.rebalance(dry_run=True), 1)
+        self.assertEqual(Ticket.objects.using('shard0').count(), 4)
+
+        log = []
+        self.assertEqual(sharding.rebalance(grace_seconds=0, log=log.append), 1)
+        self.assertEqual(ShardPlacement.objects.get(user=owner).shard, 'shard1')
+        self.assertEqual(
+            set(Ticket.objects.using('shard1').values_list('created_by', flat=True)), {owner.pk}
+        )
+        self.assertEqual(Ticket.objects.using('shard1').count(), 3)
+        self.assertEqual(self.load_index.snapshot(), loads)
+        self.assertEqual(Ticket.objects.using('shard0').get().created_by, self.owners['shard0'])
+        self.assertEqual(len(log), 1)
+
+    def test_deleting_user_mirrors_on_delete(self):
+        owner = self.owners['shard1']
+        owned = self.create_ticket('shard1', assignee=self.staff)
+        handled = self.create_ticket('shard0', assignee=self.staff)
+        change = metrics.record_status_change(handled, 'open', 'closed', self.staff)
+
+        self.staff.delete()
+        handled.refresh_from_db()
+        change.refresh_from_db()
+        self.assertIsNone(handled.assignee_id)
+        self.assertIsNone(change.changed_by_id)
+        self.assertEqual(Ticket.objects.using('shard1').get(), owned)
+
+        owner.delete()
+        self.assertFalse(Ticket.objects.using('shard1').exists())
+
+    def test_deleting_comment_author_is_protected(self):
+        author = self.owners['shard1']
+        ticket = self.create_ticket('shard0')
+        Comment.objects.create(ticket=ticket, author=author, content='Same here')
+        self.create_ticket('shard1')
+
+        with self.assertRaises(ProtectedError):
+            with transaction.atomic():
+                author.delete()
+        self.assertTrue(User.objects.filter(pk=author.pk).exists())
+        self.assertTrue(Ticket.objects.using('shard1').exists())
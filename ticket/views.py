@@ -1,40 +1,148 @@
 from rest_framework import viewsets, status
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+from django.http import Http404
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from . import metrics, sharding
+from .assignment import create_assigned_ticket, load_index
 from .models import Ticket, Comment
-from .serializers import TicketSerializer, CommentSerializer
+from .serializers import TicketSerializer, CommentSerializer, TicketStatusChangeSerializer
+
+User = get_user_model()
+
+
+def _attach_users(objects, *fields):
+    """
+    Load the users referenced by ``fields`` of ``objects`` in one query.
+
+    Users live on the default database, so they can't be joined from a shard.
+    """
+    ids = {getattr(obj, f'{field}_id') for obj in objects for field in fields} - {None}
+    users = User.objects.in_bulk(ids)
+    for obj in objects:
+        for field in fields:
+            user = users.get(getattr(obj, f'{field}_id'))
+            if user is not None:
+                setattr(obj, field, user)
+
+
+def _claim_status(ticket, new_status):
+    """
+    Move ``ticket`` to ``new_status`` with a conditional update, so concurrent
+    requests can't both replace the same status.
+
+    Returns the status that was replaced, or None if the ticket already had
+    ``new_status``.
+    """
+    tickets = Ticket.objects.using(ticket._state.db).filter(pk=ticket.pk)
+    while True:
+        current = tickets.values_list('status', flat=True).first()
+        if current is None:
+            raise Http404('No Ticket matches the given query.')
+        if current == new_status:
+            return None
+        if tickets.filter(status=current).update(status=new_status, updated_at=timezone.now()):
+            return current
 
 
 class TicketViewSet(viewsets.ModelViewSet):
     serializer_class = TicketSerializer
     permission_classes = [IsAuthenticated]
 
-    def get_queryset(self):
+    def get_shard_querysets(self):
         """
-        Return tickets based on the user's role:
-        - Admins (is_staff) see all tickets (including closed ones).
-        - Regular users see only their own tickets (any status).
+        Return one queryset per database to read, based on the user's role:
+        - Admins (is_staff) see all tickets (including closed ones), on every shard.
+        - Regular users see only tickets they opened or are assigned to (any
+          status), all of which live on their own shard.
         """
         user = self.request.user
 
         if user.is_staff:
-            queryset = Ticket.objects.all().order_by('-created_at')
+            querysets = [Ticket.objects.using(db).all() for db in sharding.get_ticket_databases()]
         else:
-            queryset = Ticket.objects.filter(assignee=user).order_by('-created_at')
+            querysets = [
+                Ticket.objects.using(sharding.shard_for_user(user.pk)).filter(
+                    Q(created_by=user) | Q(assignee=user)
+                )
+            ]
 
         # Filter by status if provided (still applied on top of base queryset)
         status_filter = self.request.query_params.get('status')
         if status_filter:
-            queryset = queryset.filter(status=status_filter)
+            querysets = [queryset.filter(status=status_filter) for queryset in querysets]
+
+        return querysets
+
+    def get_queryset(self):
+        if self.request.user.is_staff:
+            # Staff tickets span every shard, so there is no single queryset:
+            # list() merges get_shard_querysets() and get_object() uses
+            # find_ticket(). Anything else gets no tickets rather than one
+            # shard's worth.
+            return Ticket.objects.none()
+        return self.get_shard_querysets()[0].order_by('-created_at')
+
+    def list(self, request, *args, **kwargs):
+        """
+        Staff see tickets from every shard, merged newest first and paginated
+        with ?cursor= instead of ?page=.
+        """
+        if not request.user.is_staff:
+            return super().list(request, *args, **kwargs)
+
+        paginator = sharding.ShardedCursorPagination()
+        page = paginator.paginate(self.get_shard_querysets(), request)
+        _attach_users(page, 'assignee', 'created_by')
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            _attach_users(page, 'assignee', 'created_by')
+        return page
 
-        return queryset
+    def get_object(self):
+        ticket = sharding.find_ticket(self.kwargs['pk'], self.request.user)
+        if ticket is None:
+            raise Http404('No Ticket matches the given query.')
+        self.check_object_permissions(self.request, ticket)
+        return ticket
 
     def perform_create(self, serializer):
         """
-        Automatically set the assignee to the current user when creating a ticket.
+        Record the current user as the creator and route the ticket to a staff
+        member using the configured assignment strategy.
         """
-        serializer.save(assignee=self.request.user)
+        shard = sharding.writable_shard_for_user(self.request.user.pk)
+        create_assigned_ticket(
+            serializer,
+            created_by=self.request.user,
+            using=shard,
+            on_created=lambda ticket: metrics.record_ticket_created(ticket, self.request.user),
+        )
+
+    def perform_update(self, serializer):
+        instance = serializer.instance
+        sharding.check_writable(instance)
+        new_status = serializer.validated_data.get('status', instance.status)
+        with transaction.atomic(using=instance._state.db):
+            old_status = _claim_status(instance, new_status)
+            ticket = serializer.save()
+            if old_status is not None:
+                metrics.record_status_change(ticket, old_status, ticket.status, self.request.user)
+        if old_status is not None:
+            load_index.record_transition(ticket.assignee_id, old_status, ticket.status)
+
+    def perform_destroy(self, instance):
+        sharding.check_writable(instance)
+        instance.delete()
 
     @action(detail=True, methods=['patch'])
     def update_status(self, request, pk=None):
@@ -60,11 +168,28 @@ class TicketViewSet(viewsets.ModelViewSet):
             )
 
         ticket = self.get_object()
-        ticket.status = new_status
-        ticket.save()
-        
+        sharding.check_writable(ticket)
+        with transaction.atomic(using=ticket._state.db):
+            old_status = _claim_status(ticket, new_status)
+            if old_status is not None:
+                metrics.record_status_change(ticket, old_status, new_status, user)
+        if old_status is not None:
+            load_index.record_transition(ticket.assignee_id, old_status, new_status)
+        ticket.refresh_from_db()
+
         serializer = self.get_serializer(ticket)
         return Response(serializer.data)
+
+    @action(detail=True, methods=['get'])
+    def history(self, request, pk=None):
+        """
+        List the ticket's status transitions, oldest first.
+        """
+        ticket = self.get_object()
+        changes = list(ticket.status_changes.order_by('changed_at', 'id'))
+        _attach_users(changes, 'changed_by')
+        serializer = TicketStatusChangeSerializer(changes, many=True)
+        return Response(serializer.data)
     
 
 class CommentViewSet(viewsets.ModelViewSet):
@@ -76,18 +201,13 @@ class CommentViewSet(viewsets.ModelViewSet):
         ticket_id = self.request.query_params.get('ticket')
 
         if ticket_id:
-            # Filter comments by ticket ID, and ensure the user has access to the ticket
-            try:
-                if user.is_staff:
-                    # Admins can see comments for all tickets (including closed)
-                    ticket = Ticket.objects.get(id=ticket_id)
-                    return Comment.objects.filter(ticket=ticket).order_by('created_at')
-                else:
-                    # Regular users can only see comments for their own tickets
-                    ticket = Ticket.objects.get(id=ticket_id, assignee=user)
-                    return Comment.objects.filter(ticket=ticket).order_by('created_at')
-            except Ticket.DoesNotExist:
+            # Filter comments by ticket ID, and ensure the user has access to the ticket:
+            # admins can see comments for all tickets (including closed), regular
+            # users only for their own tickets. Comments live on the ticket's shard.
+            ticket = sharding.find_ticket(ticket_id, user)
+            if ticket is None:
                 return Comment.objects.none()
+            return Comment.objects.using(ticket._state.db).filter(ticket=ticket).order_by('created_at')
         else:
             # If no ticket specified, return empty queryset for security
             return Comment.objects.none()
@@ -102,11 +222,51 @@ class CommentViewSet(viewsets.ModelViewSet):
             pass
         else:
             # Regular users can only comment on their own tickets
-            if ticket.assignee != user:
+            if user.pk not in (ticket.assignee_id, ticket.created_by_id):
                 from rest_framework.exceptions import PermissionDenied
                 raise PermissionDenied('You do not have permission to comment on this ticket.')
         
-        serializer.save(author=user)
+        sharding.check_writable(ticket)
+        comment = serializer.save(author=user)
+        metrics.record_comment(comment)
+
+    def perform_update(self, serializer):
+        sharding.check_writable(serializer.instance.ticket)
+        serializer.save()
+
+    def perform_destroy(self, instance):
+        sharding.check_writable(instance.ticket)
+        instance.delete()
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def ticket_metrics_view(request):
+    """
+    SLA metrics for the days between ?start= and ?end= (YYYY-MM-DD, inclusive).
+    Defaults to the last 30 days.
+    """
+    start, end = metrics.default_range()
+    try:
+        if request.query_params.get('start'):
+            start = parse_date(request.query_params['start'])
+        if request.query_params.get('end'):
+            end = parse_date(request.query_params['end'])
+    except ValueError:
+        start = end = None
+
+    if start is None or end is None:
+        return Response(
+            {'error': 'Dates must be in YYYY-MM-DD format.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if start > end:
+        return Response(
+            {'error': 'start must not be after end.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    return Response(metrics.report(start, end), status=status.HTTP_200_OK)
 
 
 